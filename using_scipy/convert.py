@@ -1,53 +1,65 @@
 import logging
 import datetime
-from scipy.io import netcdf as nc
+import netCDF4
 import numpy as np
 
 logging.captureWarnings(True)
 
 _time_encoding = dict(units="seconds since 1970-01-01 00:00:00", calendar="standard")
+_time_units_lower = _time_encoding['units'].lower().encode('ascii')
 
-def create_grid_dimensions(ds, londata, latdata):
+_dim_orders = [('time', 'lat', 'lon'), ('lat', 'lon', 'time')]
+
+def create_grid_dimensions(ds, londata, latdata, store_data=True):
     """Create grid dimensions and variables on open netcdf file
 
     Parameters
     ----------
-    ds : netCDF4.Dataset or scipy.io.netcdf.netcdf_file
+    ds : netCDF4.Dataset
         open netCDF file in 'w' mode
     londata : 1D or 2D(lat,lon) array
         longitude data
     latdata : 1D or 2D(lat,lon) array
         latitude data
+    store_data : bool
+        store londata and latdata in the coord variables
+        set to False to store them later, after all definitions
+
+    Returns
+    -------
+    lonvar, latvar : coord variable objects
     """
     # get shapes and dimensions
-    nndim = np.ndim(londata) * np.ndim(latdata)
+    latshape = np.shape(latdata)
+    lonshape = np.shape(londata)
+    nndim = len(latshape) * len(lonshape)
     if nndim == 4:
         latdim = ('lat', 'lon')
         londim = ('lat', 'lon')
-        latshape = tuple([int(d) for d in np.shape(latdata)])
-        lonshape = tuple([int(d) for d in np.shape(londata)])
+        nlat, nlon = (int(d) for d in latshape)
     elif nndim == 1:
         latdim = ('lat', )
         londim = ('lon', )
-        latshape = len(latdata)
-        lonshape = len(londata)
+        nlat = int(latshape[0])
+        nlon = int(lonshape[0])
     else:
         raise ValueError("londata and latdata must have the same shape (1D or 2D).")
     # create dimensions
-    ds.createDimension('lat', latshape)
-    ds.createDimension('lon', lonshape)
+    ds.createDimension('lat', nlat)
+    ds.createDimension('lon', nlon)
     # create coord variables
     latvar = ds.createVariable('lat', 'd', latdim)
     lonvar = ds.createVariable('lon', 'd', londim)
+    # add meta and units
+    latvar.setncatts(dict(long_name='latitude', standard_name='latitude',
+        units='degrees_north'))
+    lonvar.setncatts(dict(long_name='longitude', standard_name='longitude',
+        units='degrees_east'))
     # store data
-    latvar[:] = latdata
-    lonvar[:] = londata
-    # add meta
-    latvar.long_name = latvar.standard_name = 'latitude'
-    lonvar.long_name = lonvar.standard_name = 'longitude'
-    # add units
-    latvar.units = 'degrees_north'
-    lonvar.units = 'degrees_east'
+    if store_data:
+        latvar[:] = latdata
+        lonvar[:] = londata
+    return lonvar, latvar
 
 
 def create_time_dimension(ds, ntime=None, timedata=None,
@@ -56,11 +68,14 @@ def create_time_dimension(ds, ntime=None, timedata=None,
 
     Parameters
     ----------
-    ds : netCDF4.Dataset or scipy.io.netcdf.netcdf_file
+    ds : netCDF4.Dataset
         open netCDF file in 'w' mode
     ntime : int
         length of time dimension
-        None for unlimited
+        default: length of timedata if given, else unlimited
+        (unlimited dimensions are slower to read and write)
+    timedata : array
+        time stamps to store
     units, calendar : str
         target units and calendar
         default: fd defaults
@@ -69,17 +84,19 @@ def create_time_dimension(ds, ntime=None, timedata=None,
     -------
     timevar : time variable object
     """
+    if ntime is None and timedata is not None:
+        ntime = int(np.shape(timedata)[0])
     ds.createDimension('time', ntime)
     timevar = ds.createVariable('time', 'i4', ('time',))
-    timevar.units = units
-    timevar.calendar = calendar
-    timevar.standard_name = 'time'
+    timevar.setncatts(dict(units=units, calendar=calendar, standard_name='time'))
     if timedata is not None:
         timevar[:] = timedata
     return timevar
 
 
-def create_data_variable(ds, name, dtype, dims=None, _FillValue=None, **attrs):
+def create_data_variable(ds, name, dtype, dims=None, _FillValue=None,
+        zlib=False, complevel=1, chunksizes=None, least_significant_digit=None,
+        **attrs):
     """Create data variable on netCDF dataset
 
     Parameters
@@ -95,6 +112,16 @@ def create_data_variable(ds, name, dtype, dims=None, _FillValue=None, **attrs):
         guessed if not provided
     _FillValue : int or float
         target _FillValue
+    zlib : bool
+        enable deflate compression
+    complevel : int
+        deflate compression level (1-9)
+    chunksizes : tuple
+        HDF5 chunk shape
+        default: let netCDF4 decide
+    least_significant_digit : int
+        quantize data to this number of decimals
+        improves compression ratio (requires zlib)
     attrs : dict
         attributes to add to data variable
         e.g. encoding
@@ -109,15 +136,10 @@ def create_data_variable(ds, name, dtype, dims=None, _FillValue=None, **attrs):
             dims = ('time', 'lat', 'lon')
         else:
             dims = ('lat', 'lon')
-    try:
-        datavar = ds.createVariable(name, dtype, dims, fill_value=_FillValue)
-    except TypeError:
-        # ds is scipy.io.netcdf.netcdf_file
-        datavar = ds.createVariable(name, dtype, dims)
-        if _FillValue is not None:
-            datavar._FillValue = _FillValue
-    for k,v in attrs.items():
-        setattr(datavar, k, v)
+    datavar = ds.createVariable(name, dtype, dims, fill_value=_FillValue,
+            zlib=zlib, complevel=complevel, chunksizes=chunksizes,
+            least_significant_digit=least_significant_digit)
+    datavar.setncatts(attrs)
 
     return datavar
 
@@ -132,16 +154,23 @@ def date2num(dates):
     """
     # Convert the timestamp from seconds since 1970 to year-DOY
     dates = np.atleast_1d(dates)
-    refdate = datetime.datetime(1970,1,1)
-    nums = np.asarray(
-            [(d-refdate).total_seconds() for d in dates],
-            dtype=int)
+    try:
+        nums = dates.astype('datetime64[s]').astype('int64')
+    except (TypeError, ValueError):
+        if dates.dtype != object:
+            raise
+        # objects numpy cannot cast to datetime64
+        refdate = datetime.datetime(1970,1,1)
+        nums = np.asarray(
+                [(d-refdate).total_seconds() for d in dates],
+                dtype='int64')
     return np.squeeze(nums)[()]
 
 
 def convert(infile, outfile, variable,
         name=None, units=None, long_name=None,
-        factor=None, fill_missing=None):
+        factor=None, fill_missing=None, dim_order=('time', 'lat', 'lon'),
+        quantize=None):
     """Convert a netCDF file to CF-1.6 with some reformatting
 
     Parameters
@@ -158,12 +187,29 @@ def convert(infile, outfile, variable,
         overwrite long_name attribute on variable
     factor : float
         multiply the data by this factor
-        set to None or 0 to disable
+        set to None, 0 or 1 to disable
     fill_missing : float
         replace missing data with this value
+    dim_order : tuple or str
+        dimension order of the output data variable
+        ('time', 'lat', 'lon') or ('lat', 'lon', 'time')
+        also accepted as comma-separated str (e.g. 'lat,lon,time')
+        the latter is much faster to read as time series at a point
+    quantize : int
+        number of decimals to keep (least_significant_digit)
+        None to store full precision
     """
-    with nc.netcdf_file(infile) as dsin, \
-            nc.netcdf_file(outfile, 'w') as dsout:
+    if isinstance(dim_order, str):
+        dim_order = dim_order.split(',')
+    dim_order = tuple(dim_order)
+    if dim_order not in _dim_orders:
+        raise ValueError('Unsupported dim_order: \'{}\'.'.format(','.join(dim_order)))
+    with netCDF4.Dataset(infile, 'r') as dsin, \
+            netCDF4.Dataset(outfile, 'w', format='NETCDF4', clobber=True) as dsout:
+        # work on raw values, fill values are handled below
+        dsin.set_auto_maskandscale(False)
+        # all data gets written, no need to pre-fill
+        dsout.set_fill_off()
 
         invar = dsin.variables
         try:
@@ -178,15 +224,19 @@ def convert(infile, outfile, variable,
         except KeyError:
             londata = invar['lon'][:]
             latdata = invar['lat'][:]
-        create_grid_dimensions(dsout, londata, latdata)
+        lonvar, latvar = create_grid_dimensions(dsout, londata, latdata,
+                store_data=False)
 
         # time
         intime = invar['time']
-        outunits = _time_encoding['units']
-        if intime.units[:len(outunits)].lower() != outunits.lower():
+        inunits = intime.units
+        if isinstance(inunits, str):
+            inunits = inunits.encode('ascii', 'replace')
+        if not inunits.lower().startswith(_time_units_lower):
             raise ValueError('Input time data has incompatible units: \'{}\'.'.format(intime.units))
         timedata = intime[:]
-        create_time_dimension(dsout, ntime=len(timedata), timedata=timedata)
+        ntime = int(timedata.shape[0])
+        timevar = create_time_dimension(dsout, ntime=ntime)
 
         # data variable
         if units is None:
@@ -196,23 +246,86 @@ def convert(infile, outfile, variable,
         attrs = dict(units=units, long_name=long_name)
         src_fill_value = getattr(indatavar, '_FillValue', np.nan)
         if fill_missing is None:
-            tgt_fill_value = np.nan
+            tgt_fill_value = np.float32('nan')
             attrs.update(_FillValue=tgt_fill_value)
         else:
-            tgt_fill_value = np.float(fill_missing)
+            tgt_fill_value = np.float32(fill_missing)
         if name is None:
             name = variable
+        nlat = len(dsout.dimensions['lat'])
+        nlon = len(dsout.dimensions['lon'])
+        time_last = dim_order[-1] == 'time'
+        if time_last:
+            chunksizes = (min(nlat, 5), min(nlon, 5), ntime)
+        else:
+            # aim for ~1 MB chunks
+            nchunk = min(ntime, max(1, (1 << 20) // (nlat * nlon * 4)))
+            chunksizes = (nchunk, nlat, nlon)
         outdatavar = create_data_variable(dsout, name=name,
-                dtype='f4', dims=('time', 'lat', 'lon'), **attrs)
-        # copy data
-        indata = indatavar[:].astype('f4')
-        indata = np.ma.masked_values(indata, src_fill_value, copy=False)
-        if factor:
-            indata = indata * factor
-        outdatavar[:] = indata.filled(tgt_fill_value)
-
+                dtype='f4', dims=dim_order,
+                zlib=True, complevel=1, chunksizes=chunksizes,
+                least_significant_digit=quantize, **attrs)
         dsout.Conventions = 'CF-1.6'
 
+        # done defining, store coordinate data
+        lonvar[:] = londata
+        latvar[:] = latdata
+        timevar[:] = timedata
+
+        scale = bool(factor) and factor != 1.0
+        # no need to mask if missing values come out unchanged
+        if np.isnan(src_fill_value):
+            need_mask = not np.isnan(tgt_fill_value)
+        else:
+            need_mask = scale or src_fill_value != tgt_fill_value
+
+        def prepare(sl):
+            """Mask, scale and fill a slab of raw input data"""
+            if need_mask:
+                if np.isnan(src_fill_value):
+                    mask = np.isnan(sl)
+                else:
+                    mask = np.equal(sl, src_fill_value)
+            sl = sl.astype('f4', copy=False)
+            if scale:
+                np.multiply(sl, factor, out=sl,
+                        where=~mask if need_mask else True)
+            if need_mask:
+                np.copyto(sl, tgt_fill_value, where=mask)
+            return sl
+
+        inchunking = indatavar.chunking()
+        if not isinstance(inchunking, (list, tuple)):
+            inchunking = None
+        if time_last:
+            # copy data in bands of lat rows with all time steps (~64 MB each,
+            # at least one row of output chunks), so each output chunk is
+            # written once and complete
+            height = chunksizes[0]
+            nband = max(1, 64 * 2**20 // (ntime * nlon * 4))
+            nband = max(height, nband // height * height)
+            if inchunking is not None:
+                # align with the input lat chunking, so each input chunk
+                # is decompressed for as few bands as possible
+                step = int(np.lcm(height, inchunking[1]))
+                if step <= nband:
+                    nband = nband // step * step
+            for i0 in range(0, nlat, nband):
+                i1 = i0 + nband
+                sl = prepare(indatavar[:, i0:i1, :])
+                outdatavar[i0:i1] = np.moveaxis(sl, 0, -1)
+        else:
+            # copy data in slabs of time steps (~64 MB each)
+            chunk = max(1, 64 * 2**20 // (nlat * nlon * 4))
+            if (inchunking is not None
+                    and indatavar.dimensions[0] == intime.dimensions[0]
+                    and inchunking[0] <= chunk):
+                # read whole input chunks so each is decompressed only once
+                chunk = chunk // inchunking[0] * inchunking[0]
+            for t0 in range(0, ntime, chunk):
+                t1 = t0 + chunk
+                outdatavar[t0:t1] = prepare(indatavar[t0:t1])
+
 
 if __name__ == '__main__':
 
@@ -226,6 +339,10 @@ if __name__ == '__main__':
     parser.add_argument('--long_name', help='Overwrite long_name attribute on variable')
     parser.add_argument('--factor', type=float, help='Factor to multiply the data with (default: 1)')
     parser.add_argument('--fill_missing', type=float, help='Fill missing data with this value')
+    parser.add_argument('--dim_order', metavar='ORDER',
+            default='time,lat,lon', choices=['time,lat,lon', 'lat,lon,time'],
+            help='Dimension order of the output variable: time,lat,lon (default) or lat,lon,time')
+    parser.add_argument('--quantize', type=int, help='Number of decimals to keep (improves compression)')
     args = parser.parse_args()
 
     convert(**vars(args))
@@ -1,27 +1,89 @@
 import os
 
+import numpy as np
 import xarray as xr
 import click
 
 _time_encoding = dict(units="seconds since 1970-01-01 00:00:00", calendar="standard")
 
+# default number of time steps per dask chunk
+_time_chunk = 24
+# upper limit on the size of a dask chunk
+_max_block_bytes = 64 << 20
+# target size of an HDF5 chunk
+_chunk_bytes = 1 << 20
+
+
+def data_encoding(da, least_significant_digit=None):
+    """Deflate level 1 with chunks of at most ~1 MB
+
+    dask-backed arrays get one HDF5 chunk per dask chunk along time;
+    the other dimensions are cut from the first one on to stay within
+    the chunk size
+    """
+    encoding = dict(zlib=True, complevel=1)
+    if least_significant_digit is not None:
+        encoding.update(least_significant_digit=least_significant_digit)
+    if not da.ndim:
+        return encoding
+    chunksizes = {}
+    budget = max(1, _chunk_bytes // da.dtype.itemsize)
+    if da.chunks and 'time' in da.dims:
+        chunksizes['time'] = da.chunks[da.get_axis_num('time')][0]
+        budget = max(1, budget // chunksizes['time'])
+    # keep trailing dimensions whole as long as they fit
+    for dim, size in reversed(list(zip(da.dims, da.shape))):
+        if dim in chunksizes:
+            continue
+        chunksizes[dim] = max(1, min(size, budget))
+        budget = max(1, budget // chunksizes[dim])
+    encoding.update(chunksizes=tuple(chunksizes[dim] for dim in da.dims))
+    return encoding
+
+
+def time_chunk(da):
+    """Number of time steps per dask chunk, aligned with the input chunking"""
+    stepsize = max(1, da.size // da.sizes['time']) * da.dtype.itemsize
+    maxchunk = max(1, _max_block_bytes // stepsize)
+    nchunk = min(_time_chunk, maxchunk)
+    inchunks = da.encoding.get('chunksizes')
+    if inchunks:
+        intchunk = inchunks[da.get_axis_num('time')]
+        # read whole input chunks so each is decompressed only once
+        # (or as few times as the size limit allows)
+        if intchunk <= nchunk:
+            nchunk = nchunk // intchunk * intchunk
+        else:
+            nchunk = min(intchunk, maxchunk)
+    return nchunk
+
 
 def convert(infile, outfile=None, variable=None,
-        factor=None, name=None, units=None, long_name=None):
+        factor=None, name=None, units=None, long_name=None, quantize=None):
     """Convert wgrib2 netCDF to CF-1.6 format"""
     with xr.open_dataset(infile) as ds:
         # extract data array for variable
         if variable is None:
-            da = ds.data_vars.values()[0]
+            da = next(iter(ds.data_vars.values()))
         else:
             da = ds[variable]
 
-        if factor:
-            da *= factor
+        # stream through dask in chunks of time steps
+        if 'time' in da.dims:
+            da = da.chunk({'time': time_chunk(da)})
+
+        # output is float32, so cast and scale in float32 in one pass
+        if factor and factor != 1.0:
+            da = xr.apply_ufunc(
+                    lambda a: np.multiply(a, np.float32(factor), dtype=np.float32), da,
+                    dask='parallelized', output_dtypes=[np.float32],
+                    keep_attrs=True)
+        else:
+            da = da.astype(np.float32, copy=False)
 
-        if units is not None:
+        if units is not None and da.attrs.get('units') != units:
             da.attrs['units'] = units
-        if long_name is not None:
+        if long_name is not None and da.attrs.get('long_name') != long_name:
             da.attrs['long_name'] = long_name
 
         if name is not None:
@@ -34,7 +96,10 @@ def convert(infile, outfile=None, variable=None,
 
         if outfile is None:
             outfile = os.path.splitext(infile)[0] + '_cf1.nc'
-        dsnew.to_netcdf(outfile, encoding=dict(time=_time_encoding))
+        encoding = {vn: data_encoding(dsnew[vn], least_significant_digit=quantize)
+                for vn in dsnew.data_vars}
+        encoding.update(time=_time_encoding)
+        dsnew.to_netcdf(outfile, encoding=encoding)
 
 
 @click.command()
@@ -45,6 +110,7 @@ def convert(infile, outfile=None, variable=None,
 @click.option('--name', help='Rename the variable to this name (see http://cfconventions.org/Data/cf-standard-names/36/build/cf-standard-name-table.html)')
 @click.option('--units', help='Overwrite units attribute on data variable')
 @click.option('--long_name', help='Overwrite long_name attribute on data variable')
+@click.option('--quantize', type=int, help='Number of decimals to keep (improves compression)')
 def cli(**kwargs):
     """Make netCDF file CF-1.6 compliant"""
     convert(**kwargs)
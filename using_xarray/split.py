@@ -19,16 +19,16 @@ def convert(infile, outfile=None, variable=None, rename={},
     with xr.open_dataset(infile) as ds:
         # extract data array for variable
         if variable is None:
-            da = ds.data_vars.values()[0]
+            da = next(iter(ds.data_vars.values()))
         else:
             da = ds[variable]
 
-        if factor:
+        if factor and factor != 1.0:
             da *= factor
 
-        if units is not None:
+        if units is not None and da.attrs.get('units') != units:
             da.attrs['units'] = units
-        if long_name is not None:
+        if long_name is not None and da.attrs.get('long_name') != long_name:
             da.attrs['long_name'] = long_name
 
         if newvarname:
@@ -53,7 +53,7 @@ def convert(infile, outfile=None, variable=None, rename={},
             outfilebase = os.path.splitext(outfile)[0]
 
         if split_by:
-            for i in xrange(len(dsnew[split_by])):
+            for i in range(dsnew.sizes[split_by]):
                 ext = '_{}{:04d}.nc'.format(split_by, i)
                 dssub = dsnew.isel(**{split_by: i})
                 save_ds(dssub, outfilebase + ext)